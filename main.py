@@ -2,11 +2,21 @@ import board
 import adafruit_sht4x
 import json
 import time
+import math
+import atexit
+import signal
+import threading
+import queue
 import logging
-from datetime import datetime as dt
+import logging.handlers
+from datetime import datetime as dt, timedelta
 import os
+from concurrent.futures import ThreadPoolExecutor
 from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+from sendgrid.helpers.mail import Mail, Personalization, To
+from python_http_client.exceptions import HTTPError
+import matplotlib
+matplotlib.use('Agg') # render off-screen; the pi has no display attached
 from matplotlib import pyplot as plt
 import matplotlib.dates as mdates
 from io import BytesIO
@@ -15,24 +25,69 @@ from utils import *
 import traceback
 
 eod_report_template = """Today the temperature was as follows:
-Mean: {mean_temp: .3f}˚F
-Min: {min_temp: .3f}˚F
-Max: {max_temp: .3f}˚F
+Mean: {mean_temp: .3f}˚{units}
+Min: {min_temp: .3f}˚{units}
+Max: {max_temp: .3f}˚{units}
 
 The humidity was as follows:
 Mean: {mean_hum: .3f}%
 Min: {min_hum: .3f}%
 Max: {max_hum: .3f}%
-
-<img src=\'data:image/png;base64,{plot}\'>
 """.replace('\n', '<br>')
 
-class Event(Enum):
-    TEMP_OUT_OF_RANGE = 1
-    HUM_OUT_OF_RANGE = 2
-    ERROR = 3
-    STARTING = 4
-    END_OF_DAY = 5
+eod_plot_template = "<img src=\'data:image/png;base64,{plot}\'>"
+
+class BufferedFileHandler(logging.FileHandler):
+    """
+    a FileHandler that writes through a large buffer and skips the
+    per-record flush, so batches of records land on the SD card as a
+    few big writes; call flush() to push the buffer out to disk
+    """
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering = 128 * 1024,
+                    encoding = self.encoding, errors = self.errors)
+
+    def emit(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            msg = self.format(record)
+            self.stream.write(msg + self.terminator)
+            if record.levelno >= logging.WARNING:
+                # warnings and errors go straight to disk rather than
+                # waiting in the write buffer for the periodic flush
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+class FastFormatter(logging.Formatter):
+    """
+    produces the same layout as '%(asctime)s - %(levelname)s - %(message)s'
+    but caches the second-resolution part of the timestamp between records,
+    skipping a strftime call (and the generic %-interpolation machinery)
+    per sample
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._last_sec = None
+        self._last_prefix = ""
+
+    def format(self, record):
+        sec = int(record.created)
+        if sec != self._last_sec:
+            self._last_sec = sec
+            self._last_prefix = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sec))
+        msecs = int((record.created - sec) * 1000)
+        s = f"{self._last_prefix},{msecs:03d} - {record.levelname} - {record.getMessage()}"
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            s = f"{s}\n{record.exc_text}"
+        return s
 
 class Monitor:
     def __init__(self):
@@ -40,15 +95,75 @@ class Monitor:
             config = json.load(f)
         for k, v in config.items():
             setattr(self, k, v)
+        # optional settings, defaulted for older config files
+        self.units = getattr(self, 'units', 'F')
+        self.eod_plot = getattr(self, 'eod_plot', True)
 
         self.sensor = adafruit_sht4x.SHT4x(board.I2C())
+        # single worker for running sensor reads so the sensor's conversion
+        # time can overlap with python-side work
+        self._acq = ThreadPoolExecutor(max_workers = 1)
         self.temp = None
         self.humidity = None
-        self.temp_out_of_range = False
-        self.hum_out_of_range = False
+        # range endpoints unpacked once; out-of-range state is a 2-bit
+        # mask with bit 0 for temperature and bit 1 for humidity
+        self.temp_lo, self.temp_hi = self.temp_range
+        self.hum_lo, self.hum_hi = self.humidity_range
+        self.range_mask = 0
         self.log_dir = os.path.join(self.root_dir, self.room)
         self.get_new_logger()
-        
+
+        # one client for the life of the monitor so each notification
+        # doesn't pay to construct it again
+        self.sg = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
+
+        # one figure reused for every end of day plot; only ever touched
+        # from the notifier thread
+        self._eod_fig = plt.figure(figsize = (6, 3), dpi = 72) if self.eod_plot else None
+
+        # notifications are sent from a background thread so a slow
+        # sendgrid round trip doesn't stall sampling
+        self.notify_q = queue.Queue(maxsize = 256)
+        self._notify_thread = threading.Thread(target = self._notify_worker, daemon = True)
+        self._notify_thread.start()
+        atexit.register(self._shutdown_notifier)
+
+        # make sure buffered log records reach disk when the process exits
+        # or is stopped by systemd/kill (SIGTERM)
+        atexit.register(self._close_logs)
+        signal.signal(signal.SIGTERM, self._on_sigterm)
+        self._schedule_log_flush()
+
+    def _on_sigterm(self, signum, frame):
+        self._flush_logs()
+        raise SystemExit(0)
+
+    def _flush_logs(self):
+        """
+        push buffered records through to the logfile and the logfile's
+        write buffer out to disk
+        """
+        self.log_handler.flush()
+        self.log_handler.target.flush()
+        self.csv_file.flush()
+
+    def _close_logs(self):
+        # MemoryHandler.close() drops its target reference, so grab it first
+        target = self.log_handler.target
+        self.log_handler.close()
+        target.close()
+        self.csv_file.close()
+
+    def _schedule_log_flush(self):
+        """
+        periodically flush buffered log records to disk so an
+        unexpected power loss only costs us the last minute of samples
+        """
+        self._flush_logs()
+        self._flush_timer = threading.Timer(60, self._schedule_log_flush)
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+
 
     def get_new_logger(self):
         """
@@ -64,109 +179,285 @@ class Monitor:
         os.makedirs(self.log_dir, exist_ok = True) # create the log dir if needed
 
         self.logger = logging.getLogger()
-        self.logger.handlers.clear() # clear any existing handlers
+        for h in self.logger.handlers: # close (and thereby flush) any existing handlers
+            # MemoryHandler.close() drops its target reference, so grab it first
+            target = getattr(h, 'target', None)
+            h.close()
+            if target is not None:
+                target.close() # push the old file's write buffer to disk
+        self.logger.handlers.clear()
         self.logger.setLevel(logging.INFO)
 
-        log_file_handler = logging.FileHandler(self.log_filename)
-        log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        log_file_handler.setFormatter(log_formatter)
-        self.logger.addHandler(log_file_handler)
-        self.date = dt.now().date()
+        log_file_handler = BufferedFileHandler(self.log_filename)
+        log_file_handler.setFormatter(FastFormatter())
+        # buffer INFO records in memory and only write them to the SD card
+        # in batches; WARNING and above (out-of-range notifications, errors)
+        # still flush through immediately
+        self.log_handler = logging.handlers.MemoryHandler(
+            capacity = 600,
+            flushLevel = logging.WARNING,
+            target = log_file_handler,
+            flushOnClose = True)
+        self.logger.addHandler(self.log_handler)
+
+        # machine-readable sidecar holding just epoch-ms, temperature and
+        # humidity per line; read_logfile prefers it over parsing the
+        # verbose log, which stays for humans and historical files
+        if getattr(self, 'csv_file', None) is not None:
+            self.csv_file.close()
+        self.csv_file = open(self.log_filename + '.csv', 'ab', buffering = 128 * 1024)
+
+        self.date = now.date()
+        # epoch time of the next midnight; the hot loop compares time.time()
+        # against this instead of constructing a datetime every sample
+        self.next_rollover = dt.combine(self.date + timedelta(days = 1), dt.min.time()).timestamp()
+
+        # reset the running aggregates for the end of day report
+        self.n_samples = 0
+        self.temp_sum = 0.0
+        self.temp_min = math.inf
+        self.temp_max = -math.inf
+        self.hum_sum = 0.0
+        self.hum_min = math.inf
+        self.hum_max = -math.inf
         
 
+    def _read_sensor(self):
+        """
+        fetch a temperature and humidity reading from the sensor,
+        retrying with backoff so a transient i2c glitch doesn't
+        surface as an error
+        """
+        for attempt in range(3):
+            try:
+                return self.sensor.measurements
+            except OSError:
+                if attempt == 2:
+                    raise
+                time.sleep(0.01 * (1 << attempt))
+
     def start(self):
         self.notify(Event.STARTING)
+        # hoist per-iteration attribute lookups out of the hot loop;
+        # locals are much cheaper to access than attributes in cpython
+        interval = self.interval
+        fahrenheit = self.units == 'F'
+        log_template = f"Temperature (˚{self.units}): %s; Humidity (%%): %s"
+        temp_lo, temp_hi = self.temp_lo, self.temp_hi
+        hum_lo, hum_hi = self.hum_lo, self.hum_hi
+        submit = self._acq.submit
+        read_sensor = self._read_sensor
+        monotonic = time.monotonic
+        next_wake = monotonic()
+        pending_record = None
         while True:
             try:
-                # get current measurements
-                _temp, self.humidity = self.sensor.measurements
-                self.temp = (_temp * 9/5) + 32
-
-                # check if the measurements are in range and notify if necessary
-                # temperature
-                if not (self.temp_range[0] < self.temp < self.temp_range[1]):
-                    if not self.temp_out_of_range:
-                        # if we were not already out of range notify
-                        self.temp_out_of_range = True
-                        self.notify(Event.TEMP_OUT_OF_RANGE)
-                else:
-                    self.temp_out_of_range = False
-                
-                #humidity
-                if not (self.humidity_range[0] < self.humidity < self.humidity_range[1]):
-                    if not self.hum_out_of_range:
-                        # if we were not already out of range notify
-                        self.hum_out_of_range = True
-                        self.notify(Event.HUM_OUT_OF_RANGE)
-                else:
-                    self.hum_out_of_range = False
+                # kick off the sensor read, then write the previous sample's
+                # log record while the sensor's conversion is in flight
+                measurement = submit(read_sensor)
+                if pending_record is not None:
+                    self.logger.handle(pending_record)
+                    pending_record = None
+                _temp, humidity = measurement.result()
+                temp = (_temp * 9/5) + 32 if fahrenheit else _temp
+                self.temp = temp
+                self.humidity = humidity
 
                 # if it's a new day create a new log file
-                if dt.now().date() != self.date: 
+                if time.time() >= self.next_rollover:
+                    self._flush_logs() # complete today's file before reporting on it
                     self.notify(Event.END_OF_DAY)
                     self.get_new_logger()
-                
-                # log the measurements
-                self.logger.info(f"Temperature (˚F): {self.temp}; Humidity (%): {self.humidity}")
-                time.sleep(self.interval)
 
+                # update the running aggregates for the end of day report
+                self.n_samples += 1
+                self.temp_sum += temp
+                if temp < self.temp_min: self.temp_min = temp
+                if temp > self.temp_max: self.temp_max = temp
+                self.hum_sum += humidity
+                if humidity < self.hum_min: self.hum_min = humidity
+                if humidity > self.hum_max: self.hum_max = humidity
+
+                # check if the measurements are in range and notify if
+                # necessary; a bit newly set relative to the last sample
+                # means that channel just went out of range
+                mask = ((temp <= temp_lo or temp >= temp_hi)
+                        | (humidity <= hum_lo or humidity >= hum_hi) << 1)
+                edges = mask & ~self.range_mask
+                self.range_mask = mask
+                if edges & 1:
+                    self.notify(Event.TEMP_OUT_OF_RANGE)
+                if edges & 2:
+                    self.notify(Event.HUM_OUT_OF_RANGE)
+
+                # build this sample's log record now (so it carries the
+                # measurement time) but emit it at the top of the next
+                # iteration while the next sensor read is in flight
+                pending_record = logging.LogRecord(
+                    self.logger.name, logging.INFO, __file__, 0,
+                    log_template % (temp, humidity),
+                    None, None)
+                # mirror the sample into the csv sidecar with the same
+                # timestamp, shifted to local time so the sidecar parses to
+                # the same wall times as the verbose log
+                created = pending_record.created
+                local_ms = int((created + time.localtime(created).tm_gmtoff) * 1000)
+                # sidecar temperatures are always farenheit - the unit
+                # read_logfile documents - regardless of the configured
+                # logging units, just as the text parser converts ˚C lines
+                temp_f = temp if fahrenheit else (temp * 9/5) + 32
+                self.csv_file.write(b"%d,%.3f,%.3f\n" % (local_ms, temp_f, humidity))
+
+                # sleep until an absolute deadline so the sampling cadence
+                # doesn't drift by however long the work above took
+                next_wake += interval
+                delay = next_wake - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_wake = monotonic() # resync if we overran the interval
+
+            except (KeyboardInterrupt, SystemExit):
+                raise
             except BaseException as e:
                 tb = traceback.format_exc()
                 self.logger.exception(e)
                 self.notify(Event.ERROR, tb = tb)
-                break
+                # don't take a 24h monitor down over one bad sample;
+                # back off for a few intervals and resume
+                time.sleep(interval * 5)
+                next_wake = monotonic()
 
     def notify(self, event: Event, tb:str = ""):
+        """
+        queue a notification for a specified event; the email (and any end
+        of day plotting) is built and sent on the background notifier thread
+        """
+        # snapshot everything the notification needs now, since the monitor
+        # state keeps changing while the notification waits in the queue
+        payload = {
+            'tb': tb,
+            'temp': self.temp,
+            'humidity': self.humidity,
+            'when': dt.now(),
+            }
+        if event == Event.END_OF_DAY:
+            payload.update(
+                log_filename = self.log_filename,
+                date = self.date,
+                n_samples = self.n_samples,
+                temp_sum = self.temp_sum,
+                temp_min = self.temp_min,
+                temp_max = self.temp_max,
+                hum_sum = self.hum_sum,
+                hum_min = self.hum_min,
+                hum_max = self.hum_max,
+                )
+        try:
+            self.notify_q.put_nowait((event, payload))
+        except queue.Full:
+            # don't silently drop notifications if the queue backs up
+            self._do_notify(event, payload)
+
+    def _notify_worker(self):
+        while True:
+            item = self.notify_q.get()
+            if item is None: # sentinel from _shutdown_notifier
+                break
+            event, payload = item
+            try:
+                self._do_notify(event, payload)
+            except Exception:
+                # a failed notification must never kill the notifier thread,
+                # or every later warning would be silently dropped
+                self.logger.exception(f"Error sending notification for {event}")
+            finally:
+                self.notify_q.task_done()
+
+    def _shutdown_notifier(self):
+        try:
+            self.notify_q.put_nowait(None)
+        except queue.Full:
+            pass
+        self._notify_thread.join(timeout = 30)
+
+    def _do_notify(self, event: Event, payload: dict):
         """
         function for notifying designated receivers when a specified event occurs
         """
+        when = payload['when']
         if event == Event.TEMP_OUT_OF_RANGE:
-            subj = f"[TEMPERATURE WARNING]: ROOM {self.room} - {dt.now().strftime('%m-%d-%Y %H:%M:%S')}"
-            msg = f"Temperature is out of range in room {self.room}. The current temperature reading is {self.temp:.3f} ˚F"
+            subj = f"[TEMPERATURE WARNING]: ROOM {self.room} - {when.strftime('%m-%d-%Y %H:%M:%S')}"
+            msg = f"Temperature is out of range in room {self.room}. The current temperature reading is {payload['temp']:.3f} ˚{self.units}"
             self.logger.warning("Temperature out of range. Notifying...")
         elif event == Event.HUM_OUT_OF_RANGE:
-            subj = f"[HUMIDITY WARNING]: ROOM {self.room} - {dt.now().strftime('%m-%d-%Y %H:%M:%S')}"
-            msg = f"Humidity is out of range in room {self.room}. The current humidity reading is {self.humidity:.3f} %"
+            subj = f"[HUMIDITY WARNING]: ROOM {self.room} - {when.strftime('%m-%d-%Y %H:%M:%S')}"
+            msg = f"Humidity is out of range in room {self.room}. The current humidity reading is {payload['humidity']:.3f} %"
             self.logger.warning("Humidity out of range. Notifying...")
         elif event == Event.ERROR:
-            tb = tb.replace('\n', '<br>')
-            subj = f"[ERROR WARNING]: ROOM {self.room} - {dt.now().strftime('%m-%d-%Y %H:%M:%S')}"
+            tb = payload['tb'].replace('\n', '<br>')
+            subj = f"[ERROR WARNING]: ROOM {self.room} - {when.strftime('%m-%d-%Y %H:%M:%S')}"
             msg = f"The following message was caught on the pi in room {self.room}:<br><br>{tb}"
         elif event == Event.STARTING:
             subj = f"[START NOTIFICATION]: Room {self.room}"
             msg = f"Temperature and humidity monitor in room {self.room} has started successfully."
             self.logger.info("Starting monitor. Notifying...")
         elif event == Event.END_OF_DAY:
-            subj = f"[END OF DAY REPORT]: Room {self.room} - {self.date.strftime('%m-%d-%Y')}"
-
-            # plot temperatures and humidity over the course of the day
-            fig, _, _, _, day_temps, day_humidities = plot_day_measurements(self.log_filename)
-            tmp = BytesIO()
-            fig.savefig(tmp, format = 'png')
-            plot = base64.b64encode(tmp.getvalue()).decode('utf-8')
-            plt.close(fig)
-
-            msg = eod_report_template.format(
-                mean_temp = sum(day_temps)/len(day_temps),
-                mean_hum = sum(day_humidities)/len(day_humidities), 
-                min_temp = min(day_temps), 
-                min_hum = min(day_humidities),
-                max_temp = max(day_temps),
-                max_hum = max(day_humidities),
-                plot = plot
-                )
+            subj = f"[END OF DAY REPORT]: Room {self.room} - {payload['date'].strftime('%m-%d-%Y')}"
+
+            n_samples = payload['n_samples']
+            if n_samples == 0:
+                # possible if the monitor stalled across a full day
+                msg = f"No measurements were recorded in room {self.room} today."
+            else:
+                # stats come from the running aggregates updated each sample,
+                # so there's no need to keep the day's readings in memory
+                msg = eod_report_template.format(
+                    mean_temp = payload['temp_sum'] / n_samples,
+                    mean_hum = payload['hum_sum'] / n_samples,
+                    min_temp = payload['temp_min'],
+                    min_hum = payload['hum_min'],
+                    max_temp = payload['temp_max'],
+                    max_hum = payload['hum_max'],
+                    units = self.units
+                    )
+
+                if self.eod_plot:
+                    # plot temperatures and humidity over the course of the
+                    # day, drawing into the monitor's reusable figure
+                    fig, _, _, _, _, _ = plot_day_measurements(payload['log_filename'], fig = self._eod_fig)
+                    tmp = BytesIO()
+                    fig.savefig(tmp, format = 'png')
+                    plot = base64.b64encode(tmp.getvalue()).decode('utf-8')
+                    msg += eod_plot_template.format(plot = plot)
             
-        sg = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
+        # send a single request with one personalization per receiver so
+        # SendGrid fans the message out server-side rather than making one
+        # round-trip per address
+        email = Mail(from_email = self.sender,
+                     subject = subj,
+                     html_content = msg)
         for receiver in self.receivers:
-            try:
-                email = Mail(from_email = self.sender, 
-                             to_emails = receiver,
-                             subject = subj,
-                             html_content = msg)
-                response = sg.send(email)
-                # TODO: look into status codes to make sure the status is success
-            except BaseException as e:
-                self.logger.warning(f"Error caught while notifying {receiver}: {str(e)}")
+            p = Personalization()
+            p.add_to(To(receiver))
+            email.add_personalization(p)
+        try:
+            response = self.sg.send(email)
+            # TODO: look into status codes to make sure the status is success
+        except HTTPError:
+            # one bad address can reject the whole batch, so fall back to
+            # sending per-receiver so the rest still get notified
+            for receiver in self.receivers:
+                try:
+                    email = Mail(from_email = self.sender,
+                                 to_emails = receiver,
+                                 subject = subj,
+                                 html_content = msg)
+                    response = self.sg.send(email)
+                except BaseException as e:
+                    self.logger.warning(f"Error caught while notifying {receiver}: {str(e)}")
+        except BaseException as e:
+            self.logger.warning(f"Error caught while notifying: {str(e)}")
 
 if __name__  == '__main__':
     with open("sendgrid.env", 'r') as f:
@@ -1,62 +1,182 @@
-from enum import Enum
+from enum import IntEnum
 from datetime import datetime, date, timedelta
 import typing
 import os
+import re
+import mmap
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import matplotlib.figure
 from matplotlib import pyplot as plt
 import matplotlib.dates as mdates
 
+# pattern matching one measurement line of a logfile, e.g.
+# 2024-01-01 12:00:00,123 - INFO - Temperature (˚F): 72.5; Humidity (%): 45.0
+_LOG_LINE = re.compile(
+    rb'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),(\d+) - INFO - '
+    rb'Temperature \(([^)]*)\): ([-\d.]+); Humidity \(%\): ([-\d.]+)\r?$',
+    re.M)
 
-class Event(Enum):
+# parsed logfiles keyed by (path, mtime, size) so repeat queries over the
+# same (unchanged) files skip the parse entirely
+_parse_cache = {}
+_PARSE_CACHE_SIZE = 64
+
+def _cache_store(key, value):
+    _parse_cache[key] = value
+    if len(_parse_cache) > _PARSE_CACHE_SIZE:
+        _parse_cache.pop(next(iter(_parse_cache))) # evict the oldest entry
+    return value
+
+# csv sidecars grow append-only, so remember how far into each file we've
+# parsed and pick up from there on the next call
+_tail_cache = {}
+
+def _read_csvfile(fpath: str) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    read a machine readable .log.csv sidecar written by the monitor,
+    one 'local_epoch_ms,temperature,humidity' row per sample; the
+    milliseconds are local wall time, matching the verbose log
+
+    files are parsed incrementally: repeat calls on a growing file
+    (i.e. the current day's) only read and parse the appended tail
+    """
+    st = os.stat(fpath)
+    key = (fpath, st.st_mtime_ns, st.st_size)
+    cached = _parse_cache.get(key)
+    if cached is not None:
+        return cached
+
+    ino, offset, times, temps, hums = _tail_cache.get(
+        fpath, (st.st_ino, 0, None, None, None))
+    if ino != st.st_ino or st.st_size < offset:
+        offset = 0 # replaced or truncated file; parse from the top
+    if offset == 0:
+        times = np.empty(0, dtype = 'datetime64[ms]')
+        temps = np.empty(0, dtype = np.float64)
+        hums = np.empty(0, dtype = np.float64)
+
+    with open(fpath, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    # only parse whole rows; a partial final line (flush mid-write or a
+    # crash) is left for the next call to pick up once completed
+    end = data.rfind(b'\n')
+    if end != -1:
+        arr = np.loadtxt(BytesIO(data[:end + 1]), delimiter = ',',
+                         dtype = np.float64, ndmin = 2)
+        times = np.concatenate([times, arr[:, 0].astype(np.int64).astype('datetime64[ms]')])
+        temps = np.concatenate([temps, arr[:, 1]])
+        hums = np.concatenate([hums, arr[:, 2]])
+        offset += end + 1
+
+    _tail_cache[fpath] = (st.st_ino, offset, times, temps, hums)
+    if len(_tail_cache) > _PARSE_CACHE_SIZE:
+        _tail_cache.pop(next(iter(_tail_cache)))
+    return _cache_store(key, (times, temps, hums))
+
+
+class Event(IntEnum):
     TEMP_OUT_OF_RANGE = 1
     HUM_OUT_OF_RANGE = 2
     ERROR = 3
     STARTING = 4
     END_OF_DAY = 5
 
-def read_logfile(fpath: typing.Union[str, os.PathLike] ) -> typing.Tuple[list, list, list]:
+def read_logfile(fpath: typing.Union[str, os.PathLike] ) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     read the temperature and humdity logs in a provided file
 
+    if the monitor wrote a numeric .csv sidecar for the file it is
+    read instead; otherwise the whole file is memory mapped and
+    scanned with a single compiled regex rather than parsed line by
+    line in python. results are cached, so repeat calls on an
+    unchanged file don't reparse it
+
     Args:
         fpath: typing.Union[str, os.PathLike]
             path to the logfile to read
 
     Returns:
-        times: list
-            list of datetimes corresponding to temperature
+        times: np.ndarray
+            datetime64 array of times corresponding to temperature
             and humidity readings
-        temps: list
-            list of temperatures in farenheit
-        hums: list
-            list of humidities
-    """
-
-    times = []
-    temps = []
-    hums = []
-    with open(fpath, 'r') as f:
-        for line in f:
-            if 'INFO' in line and 'Temperature' in line:
-                a, hum = line.split(';')
-                ts, temp = a.split(' - INFO - ')
-                tlabel, temp = temp.split(':')
-                temp = float(temp)
-                if 'C' in tlabel:
-                    temp = (temp * 9/5) + 32
-                _, hum = hum.split(':')
-                hum = float(hum)
-                ts, ms = ts.split(',')
-                ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
-                ts = ts + timedelta(milliseconds = float(ms))
-                
-                times.append(ts)
-                temps.append(temp)
-                hums.append(hum)
-    return times, temps, hums
-
-def plot_day_measurements(fpath: typing.Union[str, os.PathLike], 
-                          show:bool = False)-> typing.Tuple[matplotlib.figure.Figure, plt.Axes, plt.Axes, list, list, list]:
+        temps: np.ndarray
+            array of temperatures in farenheit
+        hums: np.ndarray
+            array of humidities
+    """
+
+    # prefer the numeric csv sidecar when the monitor wrote one; it's a
+    # fraction of the size and parses in a single loadtxt call
+    csv_path = os.fspath(fpath) + '.csv'
+    if os.path.exists(csv_path):
+        return _read_csvfile(csv_path)
+
+    st = os.stat(fpath)
+    key = (os.fspath(fpath), st.st_mtime_ns, st.st_size)
+    cached = _parse_cache.get(key)
+    if cached is not None:
+        return cached
+
+    # past-day text files are immutable, so a binary .npz cache written on
+    # first parse turns every later read into a plain array load
+    npz_path = key[0] + '.npz'
+    if os.path.exists(npz_path) and os.path.getmtime(npz_path) >= st.st_mtime:
+        with np.load(npz_path) as npz:
+            return _cache_store(key, (npz['times'], npz['temps'], npz['hums']))
+
+    rows = []
+    with open(fpath, 'rb') as f:
+        if st.st_size > 0:
+            mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            try:
+                # cheap substring check (memmem under the hood) before
+                # paying for a full regex scan of the buffer
+                if mm.find(b'Temperature') != -1:
+                    rows = _LOG_LINE.findall(mm)
+            finally:
+                mm.close()
+    if not rows:
+        times = np.empty(0, dtype = 'datetime64[ms]')
+        temps = np.empty(0, dtype = np.float64)
+        hums = np.empty(0, dtype = np.float64)
+    else:
+        n = len(rows)
+        ts, ms, tlabels, temps, hums = zip(*rows)
+        # the row count is known, so fromiter fills exact-size buffers
+        # with no growth reallocations
+        times = (np.array(ts, dtype = 'datetime64[s]')
+                 + np.fromiter(ms, dtype = np.int64, count = n).astype('timedelta64[ms]'))
+        temps = np.fromiter(temps, dtype = np.float64, count = n)
+        hums = np.fromiter(hums, dtype = np.float64, count = n)
+        # convert any readings logged in celsius in a single vectorized
+        # masked pass; all-farenheit files (the usual case) skip it entirely
+        celsius = np.char.find(np.array(tlabels), b'C') != -1
+        if celsius.any():
+            temps[celsius] = (temps[celsius] * 9/5) + 32
+
+    if date.fromtimestamp(st.st_mtime) < date.today():
+        try:
+            np.savez(npz_path, times = times, temps = temps, hums = hums)
+        except OSError:
+            pass # the cache is best effort
+    return _cache_store(key, (times, temps, hums))
+
+# builtin reductions dispatch through the interpreter per element; on the
+# ndarrays read_logfile returns, their numpy equivalents run as single
+# vectorized passes, so swap them in when a caller passes the builtin
+_STAT_FUNCS = {min: np.min, max: np.max, sum: np.sum}
+
+# the tick formatter is stateless so one instance serves every plot;
+# locators can't be shared the same way since matplotlib attaches them
+# to the axis they're installed on
+_TICK_FMT = mdates.DateFormatter('%-I%p')
+
+def plot_day_measurements(fpath: typing.Union[str, os.PathLike],
+                          show:bool = False,
+                          fig: matplotlib.figure.Figure = None)-> typing.Tuple[matplotlib.figure.Figure, plt.Axes, plt.Axes, np.ndarray, np.ndarray, np.ndarray]:
     """
     read the temperature and humdity logs in a provided file
     and plot the measurements over time
@@ -66,6 +186,9 @@ def plot_day_measurements(fpath: typing.Union[str, os.PathLike],
             path to the logfile to read
         show: bool (optional)
             whether or not to show the figure (defaults: False)
+        fig: matplotlib.figure.Figure (optional)
+            an existing figure to draw into instead of creating a
+            new one; the figure is cleared first
 
     Returns:
         fig: matplotlib.figure.Figure
@@ -74,27 +197,37 @@ def plot_day_measurements(fpath: typing.Union[str, os.PathLike],
             axis for temperature plot
         ax2: plt.Axes
             axis for humidity plot
-        times: list
-            list of datetimes corresponding to temperature
+        times: np.ndarray
+            datetime64 array of times corresponding to temperature
             and humidity readings
-        temps: list
-            list of temperatures in farenheit
-        hums: list
-            list of humidities
+        temps: np.ndarray
+            array of temperatures in farenheit
+        hums: np.ndarray
+            array of humidities
     """
 
     times, temps, hums = read_logfile(fpath)
-    fig, ax = plt.subplots(1,1)
-    ax.plot(times, temps, color = 'b')
+    # convert the shared time axis to matplotlib date numbers once, rather
+    # than letting each plot call re-convert the datetimes internally
+    x = mdates.date2num(times)
+    if fig is None:
+        fig, ax = plt.subplots(1,1)
+    else:
+        fig.clear()
+        ax = fig.add_subplot(1,1,1)
+    ax.plot(x, temps, color = 'b')
     ax2 = ax.twinx()
-    ax2.plot(times, hums, color = 'r')
+    ax2.plot(x, hums, color = 'r')
     ax2.set_ylabel("Humidity (%)", color = 'r')
     ax.set_ylabel("Temperature (˚F)", color = 'b')
     ax.xaxis.set_major_locator(mdates.HourLocator())
     ax.xaxis.set_minor_locator(mdates.MinuteLocator(byminute=[15,30,45]))
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%-I%p'))
-    for l in ax.xaxis.get_ticklabels()[::2] + ax.xaxis.get_ticklabels()[1::4]: 
-        l.set_visible(False)
+    ax.xaxis.set_major_formatter(_TICK_FMT)
+    # hide every other label plus every fourth offset by one, walking the
+    # label list once instead of building two sliced copies
+    for i, l in enumerate(ax.xaxis.get_ticklabels()):
+        if i % 2 == 0 or i % 4 == 1:
+            l.set_visible(False)
     if show: fig.show()
     return fig, ax, ax2, times, temps, hums
     
@@ -122,18 +255,43 @@ def get_daily_stats(func: typing.Callable, start: date, n_days: int,
             list of stats computed for the humidities
     """
 
-    dates = [start + timedelta(days = n) for n in range(n_days)]
-    files = [os.path.join(root_dir, d.strftime('%m-%d-%Y.log')) for d in dates]
-    existing_dates = []
-    temps = []
-    hums = []
-    for d, f in zip(dates, files):
-        if os.path.exists(f):
+    func = _STAT_FUNCS.get(func, func)
+    # build the span of dates and their filenames in a single fused pass;
+    # the f-string formats the fixed layout without strftime reparsing its
+    # format string for every day
+    wanted = {}
+    d = start
+    one_day = timedelta(days = 1)
+    for _ in range(n_days):
+        wanted[f"{d.month:02d}-{d.day:02d}-{d.year}.log"] = d
+        d = d + one_day
+    # find the files that exist with one directory scan instead of a
+    # stat syscall per expected filename
+    found = []
+    with os.scandir(root_dir) as it:
+        for e in it:
+            d = wanted.get(e.name)
+            if d is not None and e.is_file(follow_symlinks = False):
+                found.append((d, e.path))
+
+    # each day's file parses independently, so fan the parses out over a
+    # thread pool and reassemble the results in date order; for a handful
+    # of files the pool isn't worth its startup cost, so parse inline
+    stats = {}
+    if len(found) < 4:
+        for d, f in found:
             _, _temps, _hums = read_logfile(f)
-            existing_dates.append(d)
-            temps.append(func(_temps))
-            hums.append(func(_hums))
-    
+            stats[d] = (func(_temps), func(_hums))
+    else:
+        with ThreadPoolExecutor(max_workers = os.cpu_count()) as ex:
+            futures = {ex.submit(read_logfile, f): d for d, f in found}
+            for fut in as_completed(futures):
+                _, _temps, _hums = fut.result()
+                stats[futures[fut]] = (func(_temps), func(_hums))
+
+    existing_dates = sorted(stats)
+    temps = [stats[d][0] for d in existing_dates]
+    hums = [stats[d][1] for d in existing_dates]
     return existing_dates, temps, hums
 
 def plot_daily_stats(func: typing.Callable, start: date, n_days: int, 
@@ -173,7 +331,7 @@ def plot_daily_means(start: date, n_days: int, root_dir: typing.Union[str, os.Pa
         root_dir: typing.Union[str, os.PathLike]
             directory containing the logfiles
     """
-    plot_daily_stats(lambda x: sum(x)/len(x), start, n_days, root_dir)
+    plot_daily_stats(np.mean, start, n_days, root_dir)
 
 
 def plot_daily_mins(start: date, n_days: int, root_dir: typing.Union[str, os.PathLike]):